@@ -94,5 +94,16 @@ class BatchImageCollateFuncion(BaseCollateFunction):
                     tg['masks'] = F.interpolate(tg['masks'], size=sz, mode='nearest')
                 # raise NotImplementedError('')
 
+        if 'masks' in targets[0]:
+            # pad the gt masks to the largest mask of the batch once here, the criterion then only
+            # concatenates them. Points are sampled in normalized coordinates, so the masks need a
+            # common size, not the size of the images.
+            h = max(tg['masks'].shape[-2] for tg in targets)
+            w = max(tg['masks'].shape[-1] for tg in targets)
+            for tg in targets:
+                mh, mw = tg['masks'].shape[-2:]
+                if (mh, mw) != (h, w):
+                    tg['masks'] = F.pad(tg['masks'], (0, w - mw, 0, h - mh))
+
         return images, targets
 
@@ -63,6 +63,49 @@ def generalized_box_iou(boxes1, boxes2):
     return iou - (area - union) / area
 
 
+def elementwise_box_iou(boxes1: Tensor, boxes2: Tensor):
+    """
+    IoU between aligned pairs of boxes, boxes1[i] with boxes2[i].
+
+    The boxes should be in [x0, y0, x1, y1] format
+
+    Returns the [N] iou and union, where N = len(boxes1) = len(boxes2)
+    """
+    area1 = box_area(boxes1)
+    area2 = box_area(boxes2)
+
+    lt = torch.max(boxes1[:, :2], boxes2[:, :2])  # [N,2]
+    rb = torch.min(boxes1[:, 2:], boxes2[:, 2:])  # [N,2]
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    inter = wh[:, 0] * wh[:, 1]  # [N]
+
+    union = area1 + area2 - inter
+
+    iou = inter / union
+    return iou, union
+
+
+def elementwise_generalized_box_iou(boxes1: Tensor, boxes2: Tensor) -> Tensor:
+    """
+    Generalized IoU between aligned pairs of boxes, equal to
+    torch.diag(generalized_box_iou(boxes1, boxes2)) without building the [N, N] matrix.
+
+    The boxes should be in [x0, y0, x1, y1] format
+
+    Returns a [N] tensor, where N = len(boxes1) = len(boxes2)
+    """
+    iou, union = elementwise_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[:, :2], boxes2[:, :2])
+    rb = torch.max(boxes1[:, 2:], boxes2[:, 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    area = wh[:, 0] * wh[:, 1]
+
+    return iou - (area - union) / area
+
+
 def masks_to_boxes(masks):
     """Compute the bounding boxes around the provided masks
 
@@ -12,14 +12,18 @@ Copyright (c) 2023 lyuwenyu. All Rights Reserved.
 """
 
 
+import re
+import dataclasses
 import torch 
 import torch.nn as nn 
 import torch.distributed
 import torch.nn.functional as F 
 import torchvision
 
-from .box_ops import box_cxcywh_to_xyxy, box_iou, generalized_box_iou
-from ...misc.dist_utils import get_world_size, is_dist_available_and_initialized, nested_tensor_from_tensor_list
+from typing import Optional, Tuple
+
+from .box_ops import box_cxcywh_to_xyxy, elementwise_box_iou, elementwise_generalized_box_iou
+from ...misc.dist_utils import get_world_size, is_dist_available_and_initialized
 
 # helper for pointwise loss
 def point_sample(input, point_coords, **kwargs):
@@ -94,11 +98,7 @@ def get_uncertain_point_coords_with_randomness(
     num_uncertain_points = int(importance_sample_ratio * num_points)
     num_random_points = num_points - num_uncertain_points
     idx = torch.topk(point_uncertainties[:, 0, :], k=num_uncertain_points, dim=1)[1]
-    shift = num_sampled * torch.arange(num_boxes, dtype=torch.long, device=coarse_logits.device)
-    idx += shift[:, None]
-    point_coords = point_coords.view(-1, 2)[idx.view(-1), :].view(
-        num_boxes, num_uncertain_points, 2
-    )
+    point_coords = torch.gather(point_coords, 1, idx.unsqueeze(-1).expand(-1, -1, 2))
     # if num_random_points > 0:
     #     point_coords = cat(
     #         [
@@ -112,52 +112,60 @@ def get_uncertain_point_coords_with_randomness(
         point_coords = torch.cat((point_coords, random_coords), dim=1)
     return point_coords
 
-def sigmoid_ce_loss(
+def bce_dice_loss(
         inputs: torch.Tensor,
         targets: torch.Tensor,
-        num_masks: float,
-    ):
+        num_masks: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
     """
+    Compute the sigmoid BCE loss and the DICE loss in a single pass, so the
+    point logits are read once and the sigmoid is materialized only once.
+    The elementwise part runs in the dtype of the inputs, the reductions in float32.
     Args:
-        inputs: A float tensor of arbitrary shape.
+        inputs: A float tensor of shape (R, P).
                 The predictions for each example.
         targets: A float tensor with the same shape as inputs. Stores the binary
                  classification label for each element in inputs
                 (0 for the negative class and 1 for the positive class).
     Returns:
-        Loss tensor
+        (loss_bce, loss_dice) tuple of scalar tensors
     """
-    loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none")
+    bce = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none")
+    loss_bce = bce.mean(1, dtype=torch.float32).sum() / num_masks
 
-    return loss.mean(1).sum() / num_masks
+    prob = inputs.sigmoid()
+    numerator = 2 * (prob * targets).sum(-1, dtype=torch.float32)
+    denominator = prob.sum(-1, dtype=torch.float32) + targets.sum(-1, dtype=torch.float32)
+    loss_dice = (1 - (numerator + 1) / (denominator + 1)).sum() / num_masks
+    return loss_bce, loss_dice
 
-sigmoid_ce_loss_jit = torch.jit.script(
-    sigmoid_ce_loss
+bce_dice_loss_jit = torch.jit.script(
+    bce_dice_loss
 )  # type: torch.jit.ScriptModule
 
-def dice_loss(
+def vfl_loss(
         inputs: torch.Tensor,
-        targets: torch.Tensor,
-        num_masks: float,
+        target: torch.Tensor,
+        target_score: torch.Tensor,
+        alpha: float,
+        gamma: float,
     ):
     """
-    Compute the DICE loss, similar to generalized IOU for masks
+    Varifocal loss, summed over queries after averaging over them per image.
     Args:
-        inputs: A float tensor of arbitrary shape.
-                The predictions for each example.
-        targets: A float tensor with the same shape as inputs. Stores the binary
-                 classification label for each element in inputs
-                (0 for the negative class and 1 for the positive class).
+        inputs: A float tensor of shape (B, Q, C) with the classification logits.
+        target: A tensor with the same shape as inputs, one-hot encoding of the matched classes.
+        target_score: A float tensor with the same shape as inputs, the IoU-aware target scores.
+    Returns:
+        Loss tensor
     """
-    inputs = inputs.sigmoid()
-    inputs = inputs.flatten(1)
-    numerator = 2 * (inputs * targets).sum(-1)
-    denominator = inputs.sum(-1) + targets.sum(-1)
-    loss = 1 - (numerator + 1) / (denominator + 1)
-    return loss.sum() / num_masks
-
-dice_loss_jit = torch.jit.script(
-    dice_loss
+    pred_score = inputs.detach().sigmoid()
+    weight = alpha * pred_score.pow(gamma) * (1 - target) + target_score
+    loss = F.binary_cross_entropy_with_logits(inputs, target_score, weight=weight, reduction="none")
+    return loss.mean(1).sum()
+
+vfl_loss_jit = torch.jit.script(
+    vfl_loss
 )  # type: torch.jit.ScriptModule
 
 def calculate_uncertainty(logits):
@@ -173,8 +181,23 @@ def calculate_uncertainty(logits):
             the most uncertain locations having the highest uncertainty score.
     """
     assert logits.shape[1] == 1
-    gt_class_logits = logits.clone()
-    return -(torch.abs(gt_class_logits))
+    return -(torch.abs(logits))
+
+@dataclasses.dataclass
+class LayerContext:
+    """Matched predictions and targets of one decoder layer, shared by all of its losses.
+    The target fields only depend on the matching; src_boxes / src_boxes_xyxy are per layer.
+    """
+    src_idx: Tuple[torch.Tensor, torch.Tensor]
+    tgt_idx: Tuple[torch.Tensor, torch.Tensor]
+    target_classes_o: torch.Tensor
+    target_boxes: torch.Tensor
+    target_boxes_xyxy: torch.Tensor
+    target_classes: Optional[torch.Tensor] = None
+    target_onehot: Optional[torch.Tensor] = None
+    target_masks: Optional[torch.Tensor] = None
+    src_boxes: Optional[torch.Tensor] = None
+    src_boxes_xyxy: Optional[torch.Tensor] = None
 
 class RTDETRCriterion(nn.Module):
     """ This class computes the loss for DETR.
@@ -184,7 +207,8 @@ class RTDETRCriterion(nn.Module):
     """
 
     def __init__(self, matcher, weight_dict, losses, alpha=0.2, gamma=2.0, eos_coef=1e-4, num_classes=80, 
-                 num_points=12544, oversample_ratio=3.0, importance_sample_ratio=0.75):
+                 num_points=12544, oversample_ratio=3.0, importance_sample_ratio=0.75, bf16_mask_loss=True,
+                 compile_point_sampling=False):
         """ Create the criterion.
         Parameters:
             num_classes: number of object categories, omitting the special no-object category
@@ -195,6 +219,8 @@ class RTDETRCriterion(nn.Module):
             num_points: The number of points to sample for mask loss calculation.
             oversample_ratio: The ratio to oversample points based on uncertainty.
             importance_sample_ratio: The ratio of points sampled from uncertain regions.
+            bf16_mask_loss: Run the pointwise mask loss in bfloat16 (with float32 reductions) on GPUs with native bfloat16.
+            compile_point_sampling: Run the uncertainty-based point sampling through torch.compile.
         """
         super().__init__()
         self.num_classes = num_classes
@@ -210,25 +236,31 @@ class RTDETRCriterion(nn.Module):
         self.num_points = num_points
         self.oversample_ratio = oversample_ratio
         self.importance_sample_ratio = importance_sample_ratio
+        self.bf16_mask_loss = bf16_mask_loss
+        # opt-in like the model compile in warp_model, torch.compile needs a working inductor toolchain
+        self.get_uncertain_point_coords = torch.compile(get_uncertain_point_coords_with_randomness, dynamic=True) \
+            if compile_point_sampling else get_uncertain_point_coords_with_randomness
 
         self.alpha = alpha
         self.gamma = gamma
 
-    def loss_masks(self, outputs, targets, indices, num_masks):
+        # bookkeeping for the sync-free nan/inf guard, see _replace_unstable_losses
+        self.unstable_log_interval = 100
+        self._num_unstable = None
+        self._num_steps = 0
+        self._replacement_cache = {}
+
+    def loss_masks(self, outputs, targets, indices, num_masks, ctx=None, **kwargs):
         """Compute the losses related to the masks: the focal loss and the dice loss.
         targets dicts must contain the key "masks" containing a tensor of dim [nb_target_boxes, h, w]
         """
         assert "pred_masks" in outputs
 
-        src_idx = self._get_src_permutation_idx(indices)
-        tgt_idx = self._get_tgt_permutation_idx(indices)
+        if ctx is None or ctx.target_masks is None:
+            ctx = self._prepare_layer(outputs, indices, targets, self._get_target_masks(targets))
         src_masks = outputs["pred_masks"]
-        src_masks = src_masks[src_idx]
-        masks = [t["masks"] for t in targets]
-        # TODO use valid to mask invalid areas due to padding in loss
-        target_masks, valid = nested_tensor_from_tensor_list(masks).decompose()
-        target_masks = target_masks.to(src_masks)
-        target_masks = target_masks[tgt_idx]
+        src_masks = src_masks[ctx.src_idx]
+        target_masks = ctx.target_masks.to(src_masks)
 
         # No need to upsample predictions as we are using normalized coordinates :)
         # N x 1 x H x W
@@ -237,9 +269,9 @@ class RTDETRCriterion(nn.Module):
 
         with torch.no_grad():
             # sample point_coords
-            point_coords = get_uncertain_point_coords_with_randomness(
+            point_coords = self.get_uncertain_point_coords(
                 src_masks,
-                lambda logits: calculate_uncertainty(logits),
+                calculate_uncertainty,
                 self.num_points,
                 self.oversample_ratio,
                 self.importance_sample_ratio,
@@ -257,84 +289,87 @@ class RTDETRCriterion(nn.Module):
             align_corners=False,
         ).squeeze(1)
 
-        # clamp the logits to the safe range of float16
-        point_logits = torch.clamp(point_logits, min=-15.0, max=15.0)
-
+        # binary_cross_entropy_with_logits is stable for any logit, so no clamping is needed.
+        # The [R, num_points] elementwise chain is memory bound, so it runs in bfloat16 on GPUs with native
+        # support (bfloat16 keeps the float32 range, unlike float16) and the fused kernel reduces in float32.
+        # The maps are sampled in their own dtype and only the [R, num_points] samples are cast.
+        if self.bf16_mask_loss and point_logits.is_cuda and torch.cuda.is_bf16_supported(including_emulation=False):
+            loss_dtype = torch.bfloat16
+        else:
+            loss_dtype = torch.float32
+        with torch.amp.autocast(device_type=point_logits.device.type, enabled=False):
+            loss_mask_bce, loss_mask_dice = bce_dice_loss_jit(
+                point_logits.to(loss_dtype), point_labels.to(loss_dtype), num_masks)
         losses = {
-            "loss_mask_bce": sigmoid_ce_loss_jit(point_logits, point_labels, num_masks),
-            "loss_mask_dice": dice_loss_jit(point_logits, point_labels, num_masks),
+            "loss_mask_bce": loss_mask_bce,
+            "loss_mask_dice": loss_mask_dice,
         }
 
         del src_masks
         del target_masks
         return losses
 
-    def loss_labels(self, outputs, targets, indices, num_boxes, log=True):
+    def loss_labels(self, outputs, targets, indices, num_boxes, log=True, ctx=None, **kwargs):
         """Classification loss (NLL)
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
         assert 'pred_logits' in outputs
         src_logits = outputs['pred_logits']
 
-        idx = self._get_src_permutation_idx(indices)
-        target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
-        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
-                                    dtype=torch.int64, device=src_logits.device)
-        target_classes[idx] = target_classes_o
+        if ctx is None:
+            ctx = self._prepare_layer(outputs, indices, targets)
+        target_classes = ctx.target_classes
 
-        loss_ce = F.cross_entropy(src_logits.transpose(1, 2), target_classes, self.empty_weight)
+        # weighted NLL over the last dim, same as cross_entropy on the transposed logits without the copy
+        nll = -F.log_softmax(src_logits, dim=-1).gather(-1, target_classes.unsqueeze(-1)).squeeze(-1)
+        weight = self.empty_weight[target_classes]
+        loss_ce = (nll * weight).sum() / weight.sum()
         losses = {'loss_ce': loss_ce}
 
         if log:
             # TODO this should probably be a separate loss, not hacked in this one here
-            losses['class_error'] = 100 - accuracy(src_logits[idx], target_classes_o)[0]
+            losses['class_error'] = 100 - accuracy(src_logits[ctx.src_idx], ctx.target_classes_o)[0]
         return losses
 
-    def loss_labels_focal(self, outputs, targets, indices, num_boxes, log=True):
+    def loss_labels_focal(self, outputs, targets, indices, num_boxes, log=True, ctx=None, **kwargs):
         assert 'pred_logits' in outputs
         src_logits = outputs['pred_logits']
 
-        idx = self._get_src_permutation_idx(indices)
-        target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
-        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
-                                    dtype=torch.int64, device=src_logits.device)
-        target_classes[idx] = target_classes_o
+        if ctx is None:
+            ctx = self._prepare_layer(outputs, indices, targets)
+        target = ctx.target_onehot
+        if target is None:
+            target = self._get_onehot_target(ctx.target_classes, src_logits.dtype)
 
-        target = F.one_hot(target_classes, num_classes=self.num_classes+1)[..., :-1]
         loss = torchvision.ops.sigmoid_focal_loss(src_logits, target, self.alpha, self.gamma, reduction='none')
         loss = loss.mean(1).sum() * src_logits.shape[1] / num_boxes
 
         return {'loss_focal': loss}
 
-    def loss_labels_vfl(self, outputs, targets, indices, num_boxes, log=True):
+    def loss_labels_vfl(self, outputs, targets, indices, num_boxes, log=True, ctx=None, **kwargs):
         assert 'pred_boxes' in outputs
-        idx = self._get_src_permutation_idx(indices)
+        src_logits = outputs['pred_logits']
+        if ctx is None:
+            ctx = self._prepare_layer(outputs, indices, targets)
 
-        src_boxes = outputs['pred_boxes'][idx]
-        target_boxes = torch.cat([t['boxes'][i] for t, (_, i) in zip(targets, indices)], dim=0)
-        ious, _ = box_iou(box_cxcywh_to_xyxy(src_boxes), box_cxcywh_to_xyxy(target_boxes))
-        ious = torch.diag(ious).detach()
+        ious, _ = elementwise_box_iou(ctx.src_boxes_xyxy, ctx.target_boxes_xyxy)
+        ious = ious.detach()
 
-        src_logits = outputs['pred_logits']
-        target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
-        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
-                                    dtype=torch.int64, device=src_logits.device)
-        target_classes[idx] = target_classes_o
-        target = F.one_hot(target_classes, num_classes=self.num_classes + 1)[..., :-1]
+        target_classes = ctx.target_classes
+        target = ctx.target_onehot
+        if target is None:
+            target = self._get_onehot_target(target_classes, src_logits.dtype)
 
         target_score_o = torch.zeros_like(target_classes, dtype=src_logits.dtype)
-        target_score_o[idx] = ious.to(target_score_o.dtype)
+        target_score_o[ctx.src_idx] = ious.to(target_score_o.dtype)
         target_score = target_score_o.unsqueeze(-1) * target
 
-        pred_score = F.sigmoid(src_logits).detach()
-        weight = self.alpha * pred_score.pow(self.gamma) * (1 - target) + target_score
-        
-        loss = F.binary_cross_entropy_with_logits(src_logits, target_score, weight=weight, reduction='none')
-        loss = loss.mean(1).sum() * src_logits.shape[1] / num_boxes
+        loss = vfl_loss_jit(src_logits, target, target_score, self.alpha, self.gamma)
+        loss = loss * src_logits.shape[1] / num_boxes
         return {'loss_vfl': loss}
 
     @torch.no_grad()
-    def loss_cardinality(self, outputs, targets, indices, num_boxes):
+    def loss_cardinality(self, outputs, targets, indices, num_boxes, **kwargs):
         """ Compute the cardinality error, ie the absolute error in the number of predicted non-empty boxes
         This is not really a loss, it is intended for logging purposes only. It doesn't propagate gradients
         """
@@ -347,37 +382,98 @@ class RTDETRCriterion(nn.Module):
         losses = {'cardinality_error': card_err}
         return losses
 
-    def loss_boxes(self, outputs, targets, indices, num_boxes):
+    def loss_boxes(self, outputs, targets, indices, num_boxes, ctx=None, **kwargs):
         """Compute the losses related to the bounding boxes, the L1 regression loss and the GIoU loss
            targets dicts must contain the key "boxes" containing a tensor of dim [nb_target_boxes, 4]
            The target boxes are expected in format (center_x, center_y, w, h), normalized by the image size.
         """
         assert 'pred_boxes' in outputs
-        idx = self._get_src_permutation_idx(indices)
-        src_boxes = outputs['pred_boxes'][idx]
-        target_boxes = torch.cat([t['boxes'][i] for t, (_, i) in zip(targets, indices)], dim=0)
+        if ctx is None:
+            ctx = self._prepare_layer(outputs, indices, targets)
 
         losses = {}
 
-        loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none')
+        loss_bbox = F.l1_loss(ctx.src_boxes, ctx.target_boxes, reduction='none')
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(generalized_box_iou(\
-            box_cxcywh_to_xyxy(src_boxes), box_cxcywh_to_xyxy(target_boxes)))
+        loss_giou = 1 - elementwise_generalized_box_iou(ctx.src_boxes_xyxy, ctx.target_boxes_xyxy)
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
+    def _get_onehot_target(self, target_classes, dtype):
+        # one-hot encoding without the background column, scattered directly into
+        # [B, Q, num_classes] instead of slicing a [B, Q, num_classes + 1] one_hot
+        target = torch.zeros((*target_classes.shape, self.num_classes), dtype=dtype, device=target_classes.device)
+        is_fg = (target_classes < self.num_classes).unsqueeze(-1).to(dtype)
+        return target.scatter_(2, target_classes.clamp(max=self.num_classes - 1).unsqueeze(-1), is_fg)
+
+    @staticmethod
+    def _get_batch_idx(idx_list):
+        # built on the host in one repeat_interleave instead of a full_like per image, the sizes are
+        # known there. CUDA indices get it through a pinned non_blocking copy, which does not sync the stream.
+        sizes = [len(idx) for idx in idx_list]
+        device = idx_list[0].device
+        batch_idx = torch.arange(len(idx_list), dtype=torch.int64).repeat_interleave(
+            torch.as_tensor(sizes, dtype=torch.int64), output_size=sum(sizes))
+        if device.type == 'cuda':
+            return batch_idx.pin_memory().to(device, non_blocking=True)
+        return batch_idx.to(device)
+
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
-        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
-        src_idx = torch.cat([src for (src, _) in indices])
-        return batch_idx, src_idx
+        src_list = [src for (src, _) in indices]
+        return self._get_batch_idx(src_list), torch.cat(src_list)
 
     def _get_tgt_permutation_idx(self, indices):
         # permute targets following indices
-        batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
-        tgt_idx = torch.cat([tgt for (_, tgt) in indices])
-        return batch_idx, tgt_idx
+        tgt_list = [tgt for (_, tgt) in indices]
+        return self._get_batch_idx(tgt_list), torch.cat(tgt_list)
+
+    @staticmethod
+    def _get_target_masks(targets):
+        """Concatenate the gt masks of the batch to [sum(n_i), H, W], with the offset of each image.
+        The masks are padded to a common size by the collate function (BatchImageCollateFuncion).
+        """
+        masks = [t["masks"] for t in targets]
+        # TODO mask invalid areas due to padding in loss
+        assert all(m.shape[-2:] == masks[0].shape[-2:] for m in masks), \
+            'gt masks must be padded to a common size by the collate function'
+        offsets = [0]
+        for m in masks[:-1]:
+            offsets.append(offsets[-1] + len(m))
+        return torch.cat(masks, dim=0), offsets
+
+    def _prepare_layer(self, outputs, indices, targets, target_masks=None, ctx=None):
+        """Gather the matched predictions and targets of one decoder layer into a LayerContext.
+        Layers sharing a matching (the denoising layers) pass the context of the first one as `ctx`,
+        so only their predictions are gathered again.
+        """
+        if ctx is None:
+            src_idx = self._get_src_permutation_idx(indices)
+            tgt_idx = self._get_tgt_permutation_idx(indices)
+            target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
+            target_boxes = torch.cat([t['boxes'][J] for t, (_, J) in zip(targets, indices)], dim=0)
+            ctx = LayerContext(src_idx, tgt_idx, target_classes_o, target_boxes, box_cxcywh_to_xyxy(target_boxes))
+
+            # layers without mask predictions (the encoder aux output) skip the image resolution gather
+            if target_masks is not None and 'pred_masks' in outputs:
+                masks, offsets = target_masks
+                ctx.target_masks = masks[torch.cat([J + off for (_, J), off in zip(indices, offsets)])]
+
+            if 'pred_logits' in outputs:
+                src_logits = outputs['pred_logits']
+                # every layer sharing a matching also shares the [B, Q] query layout
+                target_classes = torch.full(src_logits.shape[:2], self.num_classes,
+                                            dtype=torch.int64, device=src_logits.device)
+                target_classes[src_idx] = target_classes_o
+                ctx.target_classes = target_classes
+                if 'focal' in self.losses or 'vfl' in self.losses:
+                    ctx.target_onehot = self._get_onehot_target(target_classes, src_logits.dtype)
+
+        if 'pred_boxes' in outputs:
+            src_boxes = outputs['pred_boxes'][ctx.src_idx]
+            ctx = dataclasses.replace(ctx, src_boxes=src_boxes, src_boxes_xyxy=box_cxcywh_to_xyxy(src_boxes))
+        return ctx
 
     def get_loss(self, loss, outputs, targets, indices, num_boxes, **kwargs):
         loss_map = {
@@ -402,29 +498,28 @@ class RTDETRCriterion(nn.Module):
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
         num_boxes = sum(len(t["labels"]) for t in targets)
-        num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
+        num_boxes = torch.as_tensor(num_boxes, dtype=torch.float, device=next(iter(outputs.values())).device)
+        # the reduction runs asynchronously and overlaps with the matching below
+        num_boxes_work = None
         if is_dist_available_and_initialized():
-            torch.distributed.all_reduce(num_boxes)
-        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
-        
+            num_boxes_work = torch.distributed.all_reduce(num_boxes, async_op=True)
+
         # Retrieve the matching between the outputs of the last layer and the targets
         indices = self.matcher(outputs_without_aux, targets)['indices']
 
+        # gt masks are padded to a common size once and indexed per matching
+        target_masks = self._get_target_masks(targets) if 'masks' in self.losses else None
+        ctx = self._prepare_layer(outputs, indices, targets, target_masks)
+
+        if num_boxes_work is not None:
+            num_boxes_work.wait()
+        # kept as a 0-d tensor, calling .item() here would block on the device before any loss is computed
+        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1)
+
         # Compute all the requested losses
         losses = {}
         for loss in self.losses:
-            l_dict = self.get_loss(loss, outputs, targets, indices, num_boxes)
-            
-            # handle nan and inf values in losses
-            for k, v in l_dict.items():
-                # if not torch.isfinite(v):
-                #     print(f"WARNING: unstable loss value in '{k}'. replacing with high loss.")
-                # l_dict[k] = torch.nan_to_num(v, nan=1e5, posinf=1e5, neginf=-1e5)
-                if not torch.isfinite(v):
-                    weight = self.weight_dict.get(k, 1.0)
-                    replacement_val = 10.0 * weight 
-                    print(f"WARNING: Unstable value in '{k}'. Replacing with {replacement_val:.1f}.")
-                    l_dict[k] = torch.nan_to_num(v, nan=replacement_val, posinf=replacement_val, neginf=-replacement_val)
+            l_dict = self.get_loss(loss, outputs, targets, indices, num_boxes, ctx=ctx)
             l_dict = {k: l_dict[k] * self.weight_dict[k] for k in l_dict if k in self.weight_dict}
             losses.update(l_dict)
 
@@ -432,24 +527,19 @@ class RTDETRCriterion(nn.Module):
         if 'aux_outputs' in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
                 indices = self.matcher(aux_outputs, targets)['indices']
+                ctx = self._prepare_layer(aux_outputs, indices, targets, target_masks)
                 for loss in self.losses:
                     if loss == 'masks' and 'pred_masks' not in aux_outputs:
                         continue
                     # if loss == 'masks':
                     #     # Intermediate masks losses are too costly to compute, we ignore them.
                     #     continue
-                    kwargs = {}
+                    kwargs = {'ctx': ctx}
                     if loss == 'labels':
                         # Logging is enabled only for the last layer
-                        kwargs = {'log': False}
+                        kwargs['log'] = False
 
                     l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes, **kwargs)
-                    for k, v in l_dict.items():
-                        if not torch.isfinite(v):
-                            weight = self.weight_dict.get(k, 1.0)
-                            replacement_val = 10.0 * weight 
-                            print(f"WARNING: Unstable value in '{k}'. Replacing with {replacement_val:.1f}.")
-                            l_dict[k] = torch.nan_to_num(v, nan=replacement_val, posinf=replacement_val, neginf=-replacement_val)
                     l_dict = {k: l_dict[k] * self.weight_dict[k] for k in l_dict if k in self.weight_dict}
                     l_dict = {k + f'_aux_{i}': v for k, v in l_dict.items()}
                     losses.update(l_dict)
@@ -459,6 +549,7 @@ class RTDETRCriterion(nn.Module):
             dn_meta = outputs['dn_meta']
             dn_outputs = outputs['dn_aux_outputs']
             dn_indices = self.get_cdn_matched_indices(dn_meta, targets)
+            dn_ctx = self._prepare_layer(dn_outputs, dn_indices, targets, target_masks)
             # dn_num_boxes = len(dn_meta['known_indice'])
             scalar = dn_meta.get('scalar', 1)
             dn_num_boxes = num_boxes * scalar
@@ -466,38 +557,57 @@ class RTDETRCriterion(nn.Module):
             for loss in self.losses:
                 if loss == 'masks' and 'pred_masks' not in dn_outputs:
                     continue
-                l_dict = self.get_loss(loss, dn_outputs, targets, dn_indices, dn_num_boxes)
-                
-                # handle nan and inf values in losses
-                for k, v in l_dict.items():
-                    if not torch.isfinite(v):
-                        weight = self.weight_dict.get(k, 1.0)
-                        replacement_val = 10.0 * weight 
-                        print(f"WARNING: Unstable value in '{k}'. Replacing with {replacement_val:.1f}.")
-                        l_dict[k] = torch.nan_to_num(v, nan=replacement_val, posinf=replacement_val, neginf=-replacement_val)
-
+                l_dict = self.get_loss(loss, dn_outputs, targets, dn_indices, dn_num_boxes, ctx=dn_ctx)
                 l_dict = {k: l_dict[k] * self.weight_dict[k] for k in l_dict if k in self.weight_dict}
                 l_dict = {k + '_dn': v for k, v in l_dict.items()}
                 losses.update(l_dict)
             
             if 'aux_outputs' in dn_outputs:
                 for i, aux in enumerate(dn_outputs['aux_outputs']):
+                    # the denoising layers share dn_indices, only their predictions differ
+                    ctx = self._prepare_layer(aux, dn_indices, targets, ctx=dn_ctx)
                     for loss in self.losses:
                         if loss == 'masks' and 'pred_masks' not in aux:
                             continue
-                        l_dict = self.get_loss(loss, aux, targets, dn_indices, dn_num_boxes)
-                        # handle nan and inf values in losses
-                        for k, v in l_dict.items():
-                            if not torch.isfinite(v):
-                                weight = self.weight_dict.get(k, 1.0)
-                                replacement_val = 10.0 * weight 
-                                print(f"WARNING: Unstable value in '{k}'. Replacing with {replacement_val:.1f}.")
-                                l_dict[k] = torch.nan_to_num(v, nan=replacement_val, posinf=replacement_val, neginf=-replacement_val)
+                        l_dict = self.get_loss(loss, aux, targets, dn_indices, dn_num_boxes, ctx=ctx)
                         l_dict = {k: l_dict[k] * self.weight_dict[k] for k in l_dict if k in self.weight_dict}
                         l_dict = {k + f'_dn_{i}': v for k, v in l_dict.items()}
                         losses.update(l_dict)
 
-        return losses
+        return self._replace_unstable_losses(losses)
+
+    def _replace_unstable_losses(self, losses):
+        """Replace nan and inf losses with a high finite value.
+        The replacement is branchless so healthy steps never sync with the device; the number of
+        replaced values is accumulated on the device and only reported every `unstable_log_interval` steps.
+        """
+        if not losses:
+            return losses
+
+        keys = list(losses.keys())
+        stacked = torch.stack([losses[k].float() for k in keys])
+        # the loss keys are the same every step, so the replacement values are built once per key set
+        cache_key = (tuple(keys), stacked.device)
+        replacement = self._replacement_cache.get(cache_key)
+        if replacement is None:
+            # losses are already weighted, so the raw replacement 10 * weight is weighted as well
+            replacement = stacked.new_tensor(
+                [10.0 * self.weight_dict.get(re.sub(r'(_aux_\d+|_dn(_\d+)?)$', '', k), 1.0) ** 2 for k in keys])
+            self._replacement_cache[cache_key] = replacement
+        finite = torch.isfinite(stacked)
+        replaced = torch.where(finite, stacked, torch.where(stacked == float('-inf'), -replacement, replacement))
+
+        num_unstable = (~finite).sum()
+        self._num_unstable = num_unstable if self._num_unstable is None else self._num_unstable + num_unstable
+        self._num_steps += 1
+        if self._num_steps % self.unstable_log_interval == 0:
+            num_unstable = self._num_unstable.item()
+            if num_unstable > 0:
+                print(f"WARNING: {num_unstable} unstable loss values replaced "
+                      f"in the last {self.unstable_log_interval} steps.")
+            self._num_unstable = None
+
+        return {k: replaced[i].to(losses[k].dtype) for i, k in enumerate(keys)}
 
     @staticmethod
     def get_cdn_matched_indices(dn_meta, targets):
@@ -516,16 +626,18 @@ class RTDETRCriterion(nn.Module):
             assert pad_size % scalar == 0
             single_pad = pad_size // scalar
 
+            # build the indices directly on the device of the dn queries, no host to device copies
+            device = known_indice.device
+            group_offset = torch.arange(scalar, dtype=torch.int64, device=device).unsqueeze(1) * single_pad
+
             exc_idx = []
             for i in range(len(targets)):
                 if len(targets[i]['labels']) > 0:
-                    t = torch.arange(0, len(targets[i]['labels'])).long().cuda()
-                    t = t.unsqueeze(0).repeat(scalar, 1)
-                    tgt_idx = t.flatten()
-                    output_idx = (torch.tensor(range(scalar)) * single_pad).long().cuda().unsqueeze(1) + t
-                    output_idx = output_idx.flatten()
+                    t = torch.arange(len(targets[i]['labels']), dtype=torch.int64, device=device)
+                    tgt_idx = t.repeat(scalar)
+                    output_idx = (group_offset + t).flatten()
                 else:
-                    output_idx = tgt_idx = torch.tensor([]).long().cuda()
+                    output_idx = tgt_idx = torch.zeros(0, dtype=torch.int64, device=device)
                 exc_idx.append((output_idx, tgt_idx))
             return exc_idx
 